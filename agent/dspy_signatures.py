@@ -4,6 +4,7 @@ class Router(dspy.Signature):
     """Classify the user question into one of three categories: 'sql' (requires database), 'rag' (requires documents), or 'hybrid' (requires both)."""
     question = dspy.InputField()
     classification = dspy.OutputField(desc="One of: sql, rag, hybrid")
+    complexity = dspy.OutputField(desc="One of: simple (single table or plain lookup), complex (joins, date ranges, KPI formulas)")
 
 class GenerateSQL(dspy.Signature):
     """Generate a SQLite query based on the question and schema. 
@@ -28,4 +29,12 @@ class SynthesizeAnswer(dspy.Signature):
     
     final_answer = dspy.OutputField(desc="The answer matching format_hint")
     explanation = dspy.OutputField(desc="Brief explanation of how the answer was derived")
-    citations = dspy.OutputField(desc="List of strings: DB tables (e.g., 'Orders') and doc IDs (e.g., 'marketing::chunk1')")
\ No newline at end of file
+    citations = dspy.OutputField(desc="List of strings: DB tables (e.g., 'Orders') and doc IDs (e.g., 'marketing::chunk1')")
+
+class RouterBatch(dspy.Signature):
+    """Classify each numbered user question into one of three categories: 'sql' (requires database), 'rag' (requires documents), or 'hybrid' (requires both).
+    Also rate each question 'simple' (single table or plain lookup) or 'complex' (joins, date ranges, KPI formulas).
+    Answer every question on its own line, prefixed with the same [index] as the input.
+    """
+    questions = dspy.InputField(desc="Numbered list of questions, one per line: [1] ..., [2] ...")
+    classifications = dspy.OutputField(desc="One line per question: [index] sql|rag|hybrid simple|complex")
\ No newline at end of file
@@ -1,129 +1,249 @@
+import ast
+import json
+import re
 import dspy
-from typing import TypedDict, List, Any
+from dataclasses import dataclass, field
+from typing import List, Any, Optional
 from langgraph.graph import StateGraph, END
-from agent.dspy_signatures import Router, GenerateSQL, SynthesizeAnswer
-from agent.rag.retrieval import LocalRetriever
-from agent.tools.sqlite_tool import get_schema, execute_sql
+from agent.dspy_signatures import Router, GenerateSQL, SynthesizeAnswer, RouterBatch
+from agent.rag.retrieval import NumbaRetriever
+from agent.text import tokenize
+from agent.tools.sqlite_tool import schema_for, execute_sql
 
 # 1. Setup DSPy with Ollama
-lm = dspy.OllamaLocal(model="qwen2:1.5b", max_tokens=1000)
+# Extra kwargs are forwarded as Ollama "options"; keep_alive is a server setting
+# (OLLAMA_KEEP_ALIVE) so the model and its prompt-prefix cache stay loaded between calls.
+# Pinned k-quant build; the untagged qwen2:1.5b is q4_0, so this is a similar size with slightly better accuracy
+MODEL = "qwen2:1.5b-instruct-q4_K_M"
+lm = dspy.OllamaLocal(model=MODEL, max_tokens=1000, num_ctx=2048, num_batch=256)
 dspy.settings.configure(lm=lm)
 
 # 2. Define State
-class AgentState(TypedDict):
-    question: str
-    format_hint: str
-    classification: str
-    schema: str
-    doc_context: List[dict]
-    constraints: str
-    sql_query: str
-    sql_result: Any
-    sql_error: str
-    final_answer: Any
-    explanation: str
-    citations: List[str]
-    repair_count: int
+# Slotted dataclass: fixed attribute offsets instead of a dict per node transition.
+# Nodes read attributes and return partial dicts that LangGraph merges.
+@dataclass(slots=True)
+class AgentState:
+    question: str = ""
+    format_hint: str = ""
+    classification: str = ""
+    complexity: str = ""
+    schema: str = ""
+    doc_context: List[dict] = field(default_factory=list)
+    constraints: str = ""
+    sql_query: str = ""
+    sql_result: Any = None
+    sql_error: Optional[str] = None
+    final_answer: Any = None
+    explanation: str = ""
+    citations: List[str] = field(default_factory=list)
+    repair_count: int = 0
 
 # 3. Initialize Helpers
-retriever = LocalRetriever()
-db_schema = get_schema()
+retriever = NumbaRetriever()
 
 # 4. Modules (Nodes)
 router_module = dspy.Predict(Router)
-sql_gen_module = dspy.ChainOfThought(GenerateSQL) # CoT helps logic
+sql_gen_module = dspy.Predict(GenerateSQL)
+sql_gen_cot_module = dspy.ChainOfThought(GenerateSQL) # CoT helps logic on complex questions
 synthesizer_module = dspy.Predict(SynthesizeAnswer)
+router_batch_module = dspy.Predict(RouterBatch)
+
+# Questions classified per batched router call; keep <= 16 to stay inside qwen2:1.5b's usable context
+BATCH_SIZE = 8
+
+# Markdown fences qwen sometimes wraps around SQL (```sql ... ```)
+_SQL_FENCE = re.compile(r"```(?:sql)?")
+# Quoted items in a citations string such as "['Orders', \"kpi::chunk0\"]"
+_QUOTED = re.compile(r"'([^']+)'|\"([^\"]+)\"")
+# "[3] hybrid complex" lines of a batched router completion
+_INDEXED_LINE = re.compile(r"^\[(\d+)\]\s*(.*)$", re.M)
+# Keyword pre-router: a question is routed without the LLM when one side has >= 2 hits and the other none
+_SQL_KWS = frozenset({"revenue", "top", "sum", "average", "aov", "order", "orders", "category", "categories",
+                      "product", "products", "quantity"})
+_RAG_KWS = frozenset({"policy", "policies", "document", "documents", "docs", "definition", "defined",
+                      "calendar", "kpi", "according"})
+_RAG_PHRASES = ("what does", "per the docs")
 
 # --- Nodes ---
 
+def _keyword_route(question):
+    """Returns 'sql' or 'rag' when keywords alone are decisive, else None (ask the LLM)."""
+    text = question.lower()
+    words = set(tokenize(question))
+    sql_hits = len(words & _SQL_KWS)
+    rag_hits = len(words & _RAG_KWS) + sum(phrase in text for phrase in _RAG_PHRASES)
+    # Quoted names ('Summer Beverages 1997') are campaigns/terms defined in the docs
+    rag_hits += _QUOTED.search(question) is not None
+    if sql_hits >= 2 and rag_hits == 0:
+        return "sql"
+    if rag_hits >= 2 and sql_hits == 0:
+        return "rag"
+    return None
+
+def _route_one(question):
+    """(classification, complexity) for one question: keywords first, then the LLM router."""
+    classification = _keyword_route(question)
+    if classification is not None:
+        # Keyword-routed SQL questions are mostly multi-table aggregates, so they keep the CoT generator
+        return classification, "complex"
+    pred = router_module(question=question)
+    return pred.classification.lower().strip(), pred.complexity.lower().strip()
+
+def _parse_indexed(text, n):
+    """Maps the '[i] ...' lines of a batched completion back to n slots (None if missing)."""
+    parsed = [None] * n
+    for match in _INDEXED_LINE.finditer(text or ""):
+        i = int(match.group(1)) - 1
+        if 0 <= i < n and parsed[i] is None:
+            parsed[i] = match.group(2).strip()
+    return parsed
+
+def route_batch(questions):
+    """Classifies questions with one router call per BATCH_SIZE questions.
+
+    Questions the keyword pre-router settles never reach the LLM, and indices the
+    model skips fall back to the single-question router. Returns
+    (classification, complexity) pairs in input order, ready to pre-fill AgentState.
+    """
+    routes = [None] * len(questions)
+    pending = []
+    for i, question in enumerate(questions):
+        classification = _keyword_route(question)
+        if classification is None:
+            pending.append(i)
+        else:
+            routes[i] = (classification, "complex")
+
+    for start in range(0, len(pending), BATCH_SIZE):
+        bucket = pending[start:start + BATCH_SIZE]
+        numbered = "\n".join(f"[{n}] {' '.join(questions[i].split())}" for n, i in enumerate(bucket, 1))
+        pred = router_batch_module(questions=numbered)
+        for i, line in zip(bucket, _parse_indexed(pred.classifications, len(bucket))):
+            if line is None:
+                routes[i] = _route_one(questions[i])
+                continue
+            line = line.lower()
+            complexity = "complex" if "complex" in line else "simple"
+            routes[i] = (line.replace(complexity, "").strip(), complexity)
+    return routes
+
 def router_node(state: AgentState):
-    pred = router_module(question=state["question"])
-    return {"classification": pred.classification.lower().strip(), "schema": db_schema}
+    if state.classification:
+        # Pre-filled by route_batch(); only the schema is left to pick
+        return {"schema": schema_for(state.question)}
+    classification, complexity = _route_one(state.question)
+    return {"classification": classification, "complexity": complexity, "schema": schema_for(state.question)}
 
-def retrieval_node(state: AgentState):
-    results = retriever.search(state["question"])
+def _format_context(results):
     # Extract constraints/context string
-    context_str = "\n".join([f"[{r['id']}] {r['text']}" for r in results])
-    return {"doc_context": results, "constraints": context_str}
+    return "\n".join([f"[{r['id']}] {r['text']}" for r in results])
 
-def sql_gen_node(state: AgentState):
-    # Pass doc constraints to SQL gen if they exist
-    constraints = state.get("constraints", "")
-    pred = sql_gen_module(
-        question=state["question"], 
-        schema=state["schema"],
+def retrieval_node(state: AgentState):
+    results = retriever.search(state.question)
+    return {"doc_context": results, "constraints": _format_context(results)}
+
+def _sql_generator(state):
+    # The CoT rationale roughly doubles output tokens, so only pay for it on complex questions and repairs
+    if state.repair_count > 0 or "complex" in state.complexity:
+        return sql_gen_cot_module
+    return sql_gen_module
+
+def _generate_sql(module, question, schema, constraints):
+    pred = module(
+        question=question, 
+        schema=schema,
         constraints=constraints
     )
     # Cleanup SQL string (remove markdown ```sql tags if qwen adds them)
-    clean_sql = pred.sql_query.replace("```sql", "").replace("```", "").strip()
-    return {"sql_query": clean_sql}
+    return _SQL_FENCE.sub("", pred.sql_query).strip()
+
+def sql_gen_node(state: AgentState):
+    # Pass doc constraints to SQL gen if they exist
+    constraints = state.constraints
+    return {"sql_query": _generate_sql(_sql_generator(state), state.question, state.schema, constraints)}
 
 def sql_exec_node(state: AgentState):
-    result = execute_sql(state["sql_query"])
+    result = execute_sql(state.sql_query)
     if isinstance(result, str) and result.startswith("SQL Error"):
         return {"sql_result": None, "sql_error": result}
     return {"sql_result": result, "sql_error": None}
 
 def synthesizer_node(state: AgentState):
-    context_str = state.get("constraints", "")
-    sql_res = str(state.get("sql_result", "No SQL executed"))
+    context_str = state.constraints
+    sql_res = str(state.sql_result)
     
     pred = synthesizer_module(
-        question=state["question"],
-        format_hint=state["format_hint"],
-        sql_query=state.get("sql_query", ""),
+        question=state.question,
+        format_hint=state.format_hint,
+        sql_query=state.sql_query,
         sql_result=sql_res,
         doc_context=context_str
     )
     
+    return {
+        "final_answer": pred.final_answer, 
+        "explanation": pred.explanation, 
+        "citations": _parse_citations(pred.citations)
+    }
+
+def _parse_citations(citations):
     # Simple post-processing for citations list if model returns string representation
-    citations = pred.citations
     if isinstance(citations, str):
-        # Fallback parsing if Qwen returns a string like "['Orders']"
+        # Fallback parsing if Qwen returns a string like "['Orders']": JSON first, then
+        # quoted items, and only then the (much slower) Python literal parser
+        try:
+            parsed = json.loads(citations.replace("'", '"'))
+            if isinstance(parsed, list):
+                return parsed
+        except ValueError:
+            pass
+        quoted = [single or double for single, double in _QUOTED.findall(citations)]
+        if quoted:
+            return quoted
         try:
-            import ast
             citations = ast.literal_eval(citations)
         except:
             citations = [citations]
-
-    return {
-        "final_answer": pred.final_answer, 
-        "explanation": pred.explanation, 
-        "citations": citations
-    }
+    return citations
 
 def repair_node(state: AgentState):
     # A simple repair strategy: append error to question context and retry
-    current_count = state.get("repair_count", 0)
+    current_count = state.repair_count
     return {"repair_count": current_count + 1}
 
 # --- Graph Definition ---
 
-workflow = StateGraph(AgentState)
-
-workflow.add_node("router", router_node)
-workflow.add_node("retriever", retrieval_node)
-workflow.add_node("sql_gen", sql_gen_node)
-workflow.add_node("sql_exec", sql_exec_node)
-workflow.add_node("synthesizer", synthesizer_node)
-workflow.add_node("repair", repair_node)
-
-workflow.set_entry_point("router")
-
 # Conditional Logic
 def route_decision(state):
-    cls = state["classification"]
+    cls = state.classification
     if "sql" in cls or "hybrid" in cls:
         if "hybrid" in cls:
             return "hybrid" # Go to retriever first, then SQL
         return "sql" # Go straight to SQL
     return "rag" # RAG only
 
+def post_retrieval_route(state):
+    # Hybrid SQL needs the doc constraints (dates, KPI formulas), so it is generated after retrieval
+    if "hybrid" in state.classification:
+        return "sql_gen"
+    return "synthesizer"
+
 def sql_check(state):
-    if state["sql_error"] and state["repair_count"] < 2:
+    if state.sql_error and state.repair_count < 2:
         return "retry"
     return "finalize"
 
+workflow = StateGraph(AgentState)
+
+workflow.add_node("router", router_node)
+workflow.add_node("retriever", retrieval_node)
+workflow.add_node("sql_gen", sql_gen_node)
+workflow.add_node("sql_exec", sql_exec_node)
+workflow.add_node("synthesizer", synthesizer_node)
+workflow.add_node("repair", repair_node)
+
+workflow.set_entry_point("router")
+
 workflow.add_conditional_edges(
     "router",
     route_decision,
@@ -134,15 +254,6 @@ workflow.add_conditional_edges(
     }
 )
 
-# If hybrid, retriever goes to SQL gen next
-workflow.add_edge("retriever", "sql_gen") 
-
-def post_retrieval_route(state):
-    if "hybrid" in state["classification"]:
-        return "sql_gen"
-    return "synthesizer"
-
-# Redefine retriever edges
 workflow.add_conditional_edges("retriever", post_retrieval_route, {"sql_gen": "sql_gen", "synthesizer": "synthesizer"})
 
 workflow.add_edge("sql_gen", "sql_exec")
@@ -159,4 +270,4 @@ workflow.add_conditional_edges(
 workflow.add_edge("repair", "sql_gen") # Retry SQL generation
 workflow.add_edge("synthesizer", END)
 
-app = workflow.compile()
\ No newline at end of file
+app = workflow.compile()
@@ -1,48 +1,226 @@
 import os
 import glob
+import hashlib
+import mmap
+import pickle
+import numpy as np
 from rank_bm25 import BM25Okapi
+from scipy import sparse
 import re
+from agent.text import tokenize
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernel below then runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
+# Bump when chunking/tokenization or the pickled attributes change so old pickles are not reused
+INDEX_VERSION = 3
+
+# Paragraph break, i.e. the old content.split("\n\n") (CRLF-tolerant like text mode)
+_PARA_BREAK = re.compile(rb"\r?\n\r?\n")
+
+def _iter_paragraphs(path):
+    """Yields (index, text) per paragraph, slicing an mmap instead of reading the whole file."""
+    if os.path.getsize(path) == 0:
+        return  # mmap cannot map an empty file
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Simple split by double newline for chunks
+        prev = 0
+        i = 0
+        for m in _PARA_BREAK.finditer(mm):
+            yield i, mm[prev:m.start()].decode('utf-8', 'replace').replace('\r\n', '\n')
+            prev = m.end()
+            i += 1
+        yield i, mm[prev:].decode('utf-8', 'replace').replace('\r\n', '\n')
 
 class LocalRetriever:
-    def __init__(self, docs_path="docs/"):
+    # Everything derived from the docs that the pickle stores; subclasses extend it
+    _CACHED_ATTRS = ("bm25", "chunks", "chunk_ids", "corpus", "tokenized_corpus", "_term2id")
+
+    def __init__(self, docs_path="docs/", cache_dir=".cache"):
         self.chunks = []
         self.chunk_ids = []
         self.corpus = []
+        self.tokenized_corpus = []
+        self.cache_dir = cache_dir
+        self.W = None  # built by the first search_batch() call
         self.load_docs(docs_path)
-        
-        # Tokenize for BM25
-        tokenized_corpus = [doc.lower().split() for doc in self.corpus]
-        self.bm25 = BM25Okapi(tokenized_corpus)
+
+    def _index_key(self, files):
+        """Hash of the doc file names + mtimes (and the retriever class); changes whenever docs/ changes."""
+        stamp = sorted((f, os.path.getmtime(f)) for f in files)
+        return hashlib.sha1(repr((INDEX_VERSION, type(self).__name__, stamp)).encode()).hexdigest()
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f"bm25_{key}.pkl")
 
     def load_docs(self, path):
-        """Loads MD files and chunks them by headers or paragraphs."""
+        """Loads MD files and chunks them by headers or paragraphs.
+
+        The fitted BM25 index (and the _CACHED_ATTRS derived from it) is
+        pickled under cache_dir and reused while the docs are unchanged.
+        """
         files = glob.glob(os.path.join(path, "*.md"))
+        self.index_key = self._index_key(files)
+        cache_path = self._cache_path(self.index_key)
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as fh:
+                    cached = pickle.load(fh)
+                for name in self._CACHED_ATTRS:
+                    setattr(self, name, cached[name])
+                return
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError, KeyError, TypeError):
+                pass  # Corrupt cache, rebuild below
+
         for f in files:
             filename = os.path.basename(f).replace(".md", "")
-            with open(f, 'r') as file:
-                content = file.read()
-                # Simple split by double newline for chunks
-                raw_chunks = content.split("\n\n")
-                for i, chunk in enumerate(raw_chunks):
-                    if chunk.strip():
-                        chunk_id = f"{filename}::chunk{i}"
-                        self.chunks.append(chunk.strip())
-                        self.chunk_ids.append(chunk_id)
-                        self.corpus.append(chunk.strip())
+            for i, chunk in _iter_paragraphs(f):
+                chunk = chunk.strip()
+                if chunk:
+                    chunk_id = f"{filename}::chunk{i}"
+                    self.chunks.append(chunk)
+                    self.chunk_ids.append(chunk_id)
+                    self.corpus.append(chunk)
+
+        # Tokenize for BM25
+        self.tokenized_corpus = [tokenize(doc) for doc in self.corpus]
+        self.bm25 = BM25Okapi(self.tokenized_corpus)
+        self._build_index()
+        self._save_cache(cache_path)
+        self.invalidate()
+
+    def _save_cache(self, cache_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as fh:
+                pickle.dump({name: getattr(self, name) for name in self._CACHED_ATTRS}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            # Atomic swap so a concurrent reader never sees a half-written pickle
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Caching is best effort; the in-memory index is still valid
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def invalidate(self):
+        """Deletes cached indexes that no longer match the current docs."""
+        current = os.path.basename(self._cache_path(self.index_key))
+        for stale in glob.glob(os.path.join(self.cache_dir, "bm25_*.pkl")):
+            if os.path.basename(stale) != current:
+                os.remove(stale)
+
+    def _build_index(self):
+        """Derived lookup structures, built once per docs change and pickled with the index."""
+        self._term2id = {term: i for i, term in enumerate(self.bm25.idf)}
+
+    def _build_matrix(self):
+        """Builds the sparse doc x term matrix of BM25 term weights (on the first search_batch()).
+
+        W[d, t] = idf[t] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len_d / avgdl)), so
+        a query's scores are its term-count vector times W.T.
+        """
+        bm25 = self.bm25
+        rows, cols, weights = [], [], []
+        for doc_id, freqs in enumerate(bm25.doc_freqs):
+            norm = bm25.k1 * (1 - bm25.b + bm25.b * bm25.doc_len[doc_id] / bm25.avgdl)
+            for term, tf in freqs.items():
+                rows.append(doc_id)
+                cols.append(self._term2id[term])
+                weights.append(bm25.idf[term] * tf * (bm25.k1 + 1) / (tf + norm))
+        self.W = sparse.csr_matrix((weights, (rows, cols)), shape=(len(bm25.doc_freqs), len(self._term2id)))
+
+    def get_scores(self, query):
+        """BM25 score of every chunk for query."""
+        return self.bm25.get_scores(tokenize(query))
 
     def search(self, query, top_k=3):
         """Returns top_k chunks with their IDs."""
-        tokenized_query = query.lower().split()
-        scores = self.bm25.get_scores(tokenized_query)
-        top_n = self.bm25.get_top_n(tokenized_query, self.corpus, n=top_k)
-        
+        return self._top_k(self.get_scores(query), top_k)
+
+    def search_batch(self, queries, top_k=3):
+        """search() for many queries at once: one sparse matmul scores all of them."""
+        if self.W is None:
+            self._build_matrix()
+        rows, cols = [], []
+        for r, query in enumerate(queries):
+            for t in tokenize(query):
+                i = self._term2id.get(t)
+                if i is not None:
+                    rows.append(r)
+                    cols.append(i)
+        # Duplicate (row, col) entries are summed, so repeated query terms count twice as in get_scores
+        Q = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(queries), len(self._term2id)))
+        scores = (Q @ self.W.T).toarray()
+        return [self._top_k(row, top_k) for row in scores]
+
+    def _top_k(self, scores, top_k):
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        # Partial sort: only the top k indices get ordered
+        idx = np.argpartition(scores, -k)[-k:]
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+
         results = []
-        # Find indices of top_n to get IDs (naive approach for this scale)
-        for text in top_n:
-            idx = self.corpus.index(text)
+        for i in idx:
             results.append({
-                "id": self.chunk_ids[idx],
-                "text": text,
-                "score": scores[idx]
+                "id": self.chunk_ids[i],
+                "text": self.chunks[i],
+                "score": scores[i]
             })
-        return results
\ No newline at end of file
+        return results
+
+
+@njit(cache=True)
+def _bm25_score(q_term_ids, row_ptr, col, tf, doc_len, avgdl, k1, b, idf, out):
+    """Accumulates Okapi BM25 scores into out, walking only the query terms' postings."""
+    for qi in range(q_term_ids.shape[0]):
+        t = q_term_ids[qi]
+        w = idf[t]
+        for p in range(row_ptr[t], row_ptr[t + 1]):
+            d = col[p]
+            f = tf[p]
+            out[d] += w * (f * (k1 + 1.0)) / (f + k1 * (1.0 - b + b * doc_len[d] / avgdl))
+
+
+class NumbaRetriever(LocalRetriever):
+    """LocalRetriever that scores with a compiled kernel over CSR postings.
+
+    Scores match BM25Okapi.get_scores (same idf, k1, b and avgdl), but only the
+    postings of the query terms are touched instead of every document per term.
+    """
+
+    _CACHED_ATTRS = LocalRetriever._CACHED_ATTRS + ("row_ptr", "col", "tf", "idf", "doc_len")
+
+    def _build_index(self):
+        super()._build_index()
+        self._build_postings()
+
+    def _build_postings(self):
+        """Packs bm25.doc_freqs into term-major CSR arrays (row_ptr, col, tf)."""
+        postings = [[] for _ in self._term2id]
+        for doc_id, freqs in enumerate(self.bm25.doc_freqs):
+            for term, freq in freqs.items():
+                postings[self._term2id[term]].append((doc_id, freq))
+
+        self.row_ptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        self.row_ptr[1:] = np.cumsum([len(p) for p in postings])
+        self.col = np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=self.row_ptr[-1])
+        self.tf = np.fromiter((f for p in postings for _, f in p), dtype=np.float64, count=self.row_ptr[-1])
+        self.idf = np.fromiter(self.bm25.idf.values(), dtype=np.float64, count=len(self._term2id))
+        self.doc_len = np.asarray(self.bm25.doc_len, dtype=np.float64)
+
+    def query_term_ids(self, query):
+        """Query tokens as a contiguous int32 array of term ids; OOV tokens are dropped."""
+        ids = map(self._term2id.get, tokenize(query))
+        return np.fromiter((i for i in ids if i is not None), dtype=np.int32)
+
+    def get_scores(self, query):
+        q_term_ids = self.query_term_ids(query)
+        scores = np.zeros(len(self.doc_len), dtype=np.float64)
+        _bm25_score(q_term_ids, self.row_ptr, self.col, self.tf, self.doc_len,
+                    float(self.bm25.avgdl), float(self.bm25.k1), float(self.bm25.b), self.idf, scores)
+        return scores
@@ -0,0 +1,7 @@
+import re
+
+_TOK = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    """Lowercased alphanumeric tokens; 'Beverages.' and 'beverages' both give 'beverages'."""
+    return _TOK.findall(text.lower())
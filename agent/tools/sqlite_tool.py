@@ -1,44 +1,187 @@
+import functools
 import sqlite3
-import pandas as pd
+import threading
+from collections import OrderedDict
+from agent.text import tokenize
 
 DB_PATH = "data/northwind.sqlite"
 
+_CONN = None
+_CONN_LOCK = threading.Lock()
+
+# Memoized (columns, rows) per SQL string, least recently used first
+_RESULTS = OrderedDict()
+_RESULTS_MAX = 256
+_RESULTS_LOCK = threading.Lock()
+
+# Schema kept as parallel structures so subsets can be rendered per question;
+# filled once by get_schema()
+_SCHEMA_LOCK = threading.Lock()
+_TABLES = []
+_COLS_BY_TABLE = {}
+# Undirected foreign-key graph: table -> tables it joins to directly
+_FK_NEIGHBOURS = {}
+# Measures that only exist on order lines, so these words pull in the order tables
+_FACT_WORDS = frozenset({"revenue", "quantity", "sold", "sales", "aov", "margin"})
+_FACT_TABLES = ("Order Details", "Orders")
+
 def get_db_connection():
-    return sqlite3.connect(DB_PATH)
+    """Returns the shared, lazily opened connection (reused by every query)."""
+    global _CONN
+    if _CONN is None:
+        with _CONN_LOCK:
+            if _CONN is None:
+                conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+                conn.execute("PRAGMA temp_store=MEMORY")
+                _CONN = conn
+    return _CONN
 
+@functools.lru_cache(maxsize=1)
 def get_schema():
-    """Returns a simplified schema string for the LLM."""
+    """Returns a simplified schema string for the LLM.
+
+    lru_cache does not stop concurrent first calls, so the shared structures
+    are filled once, under _SCHEMA_LOCK; later callers only read them.
+    """
+    with _SCHEMA_LOCK:
+        if not _TABLES:
+            _load_schema()
+    return _render_schema(_TABLES)
+
+def _load_schema():
+    """Fills _TABLES / _COLS_BY_TABLE / _FK_NEIGHBOURS from the database."""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get tables
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
-    schema_str = ""
-    for table in tables:
-        table_name = table[0]
-        # Skip internal sqlite tables
-        if "sqlite" in table_name:
-            continue
-            
-        cursor.execute(f"PRAGMA table_info('{table_name}')")
-        columns = cursor.fetchall()
-        col_names = [col[1] for col in columns]
-        schema_str += f"Table: {table_name}\nColumns: {', '.join(col_names)}\n\n"
-    
-    conn.close()
-    return schema_str
+    with _CONN_LOCK:
+        cursor = conn.cursor()
+        
+        # Get tables
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = cursor.fetchall()
+        
+        for table in tables:
+            table_name = table[0]
+            # Skip internal sqlite tables
+            if "sqlite" in table_name:
+                continue
+                
+            cursor.execute(f"PRAGMA table_info('{table_name}')")
+            columns = cursor.fetchall()
+            _COLS_BY_TABLE[table_name] = [col[1] for col in columns]
+            cursor.execute(f"PRAGMA foreign_key_list('{table_name}')")
+            for fk in cursor.fetchall():
+                _FK_NEIGHBOURS.setdefault(table_name, set()).add(fk[2])
+                _FK_NEIGHBOURS.setdefault(fk[2], set()).add(table_name)
+            _TABLES.append(table_name)
+
+def _render_schema(tables):
+    return "".join(f"Table: {t}\nColumns: {', '.join(_COLS_BY_TABLE[t])}\n\n" for t in tables)
+
+def _singular(name):
+    if name.endswith("ies"):
+        return name[:-3] + "y"
+    return name[:-1] if name.endswith("s") else name
+
+def _join_path(picked, target):
+    """Tables on the shortest foreign-key path from any picked table to target, excluding both ends."""
+    parents = {t: None for t in picked}
+    queue = list(picked)
+    for table in queue:
+        if table == target:
+            path = []
+            table = parents[table]
+            while table is not None and table not in picked:
+                path.append(table)
+                table = parents[table]
+            return path
+        for nxt in _FK_NEIGHBOURS.get(table, ()):
+            if nxt not in parents:
+                parents[nxt] = table
+                queue.append(nxt)
+    return []  # not connected
+
+def schema_for(question, top_k=5):
+    """Schema string limited to the tables the question needs.
+
+    A table scores 2 if its name (or singular) appears in the question, plus 1
+    per column name found among the question's words; the best top_k are kept.
+    Revenue/quantity/AOV/margin words add the order tables, and tables on the
+    foreign-key path between picked tables are added so the joins can be
+    written. Falls back to the full schema when nothing matches.
+    """
+    full_schema = get_schema()  # fills _TABLES / _COLS_BY_TABLE on first call
+    text = question.lower()
+    words = set(tokenize(question))
+    scored = []
+    for pos, table in enumerate(_TABLES):
+        name = table.lower()
+        score = 2 if name in text or _singular(name) in text else 0
+        score += sum(1 for col in _COLS_BY_TABLE[table] if col.lower() in words)
+        if score:
+            scored.append((-score, pos, table))
+    picked = [table for _, _, table in sorted(scored)[:top_k]]
+    if words & _FACT_WORDS:
+        picked.extend(t for t in _FACT_TABLES if t in _COLS_BY_TABLE and t not in picked)
+    if not picked:
+        return full_schema
+    # Connect every picked table to the ones before it
+    needed = set(picked[:1])
+    for table in picked[1:]:
+        needed.update(_join_path(needed, table))
+        needed.add(table)
+    # Render in database order
+    return _render_schema([t for t in _TABLES if t in needed])
+
+def _run_query(query):
+    """Runs query and returns (columns, rows) as tuples; columns is empty for statements without a result set."""
+    conn = get_db_connection()
+    # Enable case-insensitive logic if needed, but standard SQL usually fine
+    with _CONN_LOCK:
+        try:
+            cursor = conn.execute(query)
+            cursor.arraysize = 1000
+            cols = tuple(d[0] for d in cursor.description) if cursor.description else ()
+            rows = tuple(cursor.fetchall()) if cols else ()
+        finally:
+            # Closing used to discard uncommitted writes; keep that on the shared connection
+            if conn.in_transaction:
+                conn.rollback()
+    return cols, rows
+
+def _execute_sql_cached(query):
+    """_run_query memoized per SQL string (LRU, _RESULTS_MAX entries).
+
+    Only queries with a result set are stored: statements without one (CREATE,
+    INSERT, ...) run every time, so a repeat reports its live error. Safe
+    because the app only reads the database; call clear_cache() after writes.
+    Errors propagate and are therefore not cached.
+    """
+    with _RESULTS_LOCK:
+        hit = _RESULTS.get(query)
+        if hit is not None:
+            _RESULTS.move_to_end(query)
+            return hit
+    result = _run_query(query)
+    if result[0]:
+        with _RESULTS_LOCK:
+            _RESULTS[query] = result
+            if len(_RESULTS) > _RESULTS_MAX:
+                _RESULTS.popitem(last=False)
+    return result
+
+def clear_cache():
+    """Drops memoized query results."""
+    with _RESULTS_LOCK:
+        _RESULTS.clear()
 
 def execute_sql(query):
     """Executes SQL and returns results as a list of dicts or error string."""
     try:
-        conn = get_db_connection()
-        # Enable case-insensitive logic if needed, but standard SQL usually fine
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        if df.empty:
-            return "Query executed successfully but returned 0 rows."
-        return df.to_dict(orient="records")
+        cols, rows = _execute_sql_cached(query.strip())
     except Exception as e:
-        return f"SQL Error: {str(e)}"
\ No newline at end of file
+        return f"SQL Error: {str(e)}"
+    if not rows:
+        return "Query executed successfully but returned 0 rows."
+    # Fresh dicts per call so callers cannot mutate the cached rows
+    return [dict(zip(cols, row)) for row in rows]
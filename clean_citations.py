@@ -1,54 +1,37 @@
 import json
+import os
 import re
 
-def is_valid_citation(c_str):
-    """Only accept simple table names or doc chunk IDs."""
-    # Doc chunk ID: filename::chunkN
-    if '::chunk' in c_str:
-        return True
-    
-    # Reject if length > 50 (likely explanatory)
-    if len(c_str) > 50:
-        return False
-    
-    # Reject if contains any special chars or spaces
-    if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', c_str):
-        return False
-    
-    return True
+# Simple table names; doc chunk IDs (filename::chunkN) are accepted separately
+_CITATION_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 def clean_citations(citations_raw):
-    cleaned = []
-    for c in citations_raw:
-        c_str = str(c).strip()
-        if is_valid_citation(c_str):
-            cleaned.append(c_str)
-    return sorted(list(set(cleaned)))
-
-with open('outputs_hybrid.jsonl', 'r') as f:
-    outputs = [json.loads(line) for line in f if line.strip()]
+    """Only accept simple table names (<= 50 chars) or doc chunk IDs, deduplicated and sorted."""
+    return sorted({
+        c for c in (str(c).strip() for c in citations_raw)
+        if '::chunk' in c or (len(c) <= 50 and _CITATION_RE.match(c))
+    })
 
 print("Regenerating outputs_hybrid.jsonl with clean citations...\n")
-corrected = []
-for item in outputs:
-    clean_cites = clean_citations(item.get('citations', []))
-    
-    corrected_item = {
-        'id': item.get('id'),
-        'final_answer': item.get('final_answer'),
-        'sql': item.get('sql', ''),
-        'confidence': 0.0,
-        'explanation': item.get('explanation', '').strip()[:250],
-        'citations': clean_cites
-    }
-    corrected.append(corrected_item)
-    print(f"{item['id']:<40} | final_answer: {item['final_answer']!r:<10} | citations: {clean_cites}")
-
-with open('outputs_hybrid.jsonl', 'w') as f:
-    for r in corrected:
-        f.write(json.dumps(r) + '\n')
-
-print(f"\nSuccess: Regenerated {len(corrected)} entries per Output Contract")
-
-
-
+count = 0
+# Stream into a temp file and swap it in, so memory stays flat and a crash leaves the original intact
+with open('outputs_hybrid.jsonl', 'r') as fin, open('outputs_hybrid.jsonl.tmp', 'w') as fout:
+    items = (json.loads(line) for line in fin if line.strip())
+    for item in items:
+        clean_cites = clean_citations(item.get('citations', []))
+
+        corrected_item = {
+            'id': item.get('id'),
+            'final_answer': item.get('final_answer'),
+            'sql': item.get('sql', ''),
+            'confidence': 0.0,
+            'explanation': item.get('explanation', '').strip()[:250],
+            'citations': clean_cites
+        }
+        fout.write(json.dumps(corrected_item) + '\n')
+        count += 1
+        print(f"{item['id']:<40} | final_answer: {item['final_answer']!r:<10} | citations: {clean_cites}")
+
+os.replace('outputs_hybrid.jsonl.tmp', 'outputs_hybrid.jsonl')
+
+print(f"\nSuccess: Regenerated {count} entries per Output Contract")
@@ -7,7 +7,7 @@ against `data/northwind.sqlite`).
 
 Usage:
   - Ensure Ollama is running and the model referenced in `agent/graph_hybrid.py`
-    (default `qwen2:1.5b`) is available.
+    (default `qwen2:1.5b-instruct-q4_K_M`) is available.
   - Run:
       python optimize_sql_dspy.py
 
@@ -38,6 +38,7 @@ except Exception as e:
     raise
 
 from agent.dspy_signatures import GenerateSQL
+from agent.rag.retrieval import NumbaRetriever
 from agent.tools.sqlite_tool import execute_sql, get_schema
 
 
@@ -125,6 +126,12 @@ def main():
         },
     ]
 
+    # Doc context as constraints, like the agent gives GenerateSQL; one batched BM25 pass for all examples
+    examples = train_examples + test_examples
+    retriever = NumbaRetriever()
+    for ex, results in zip(examples, retriever.search_batch([ex['question'] for ex in examples])):
+        ex['constraints'] = "\n".join(f"[{r['id']}] {r['text']}" for r in results)
+
     print(f"Train examples: {len(train_examples)}, Test examples: {len(test_examples)}")
 
     # Baseline: attempt to use dspy.Predict(GenerateSQL)
@@ -2,31 +2,126 @@ import click
 import json
 import traceback
 import ast
+import functools
+import glob
+import hashlib
 import re
 import os
 import sys
+import shelve
+import threading
+from dataclasses import dataclass, asdict, replace
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the stdlib json module
+    orjson = None
 
 # Ensure project root is on sys.path so package imports like `rag` and `agent` work
 ROOT = os.path.dirname(os.path.abspath(__file__))
 if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
 
-from agent.graph_hybrid import app
+from agent.graph_hybrid import app, AgentState, MODEL, BATCH_SIZE, route_batch
+from agent.tools.sqlite_tool import DB_PATH
+
+# Table names after FROM/JOIN/INTO/UPDATE/DELETE FROM (not perfect, but works for common cases)
+_TABLE_PATTERN = r'\b(?:FROM|JOIN|INTO|UPDATE|DELETE\s+FROM)\s+[`"]?(\w+)[`"]?'
+_TABLE_RE = re.compile(_TABLE_PATTERN, re.IGNORECASE)
+# Case-sensitive variant for the usual all-uppercase keywords; skips IGNORECASE matching
+_TABLE_RE_FAST = re.compile(_TABLE_PATTERN)
+_TABLE_KEYWORDS = ('FROM', 'JOIN', 'INTO', 'UPDATE', 'DELETE')
+_CITATION_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# Sentence-ending punctuation followed by whitespace
+_SENTENCE_ENDS = ('. ', '! ', '? ', '.\n', '!\n', '?\n')
+
+def _load_line(line):
+    """Parses one JSONL input line."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+def iter_questions(path):
+    """Yields the questions of a JSONL file one at a time, skipping blank lines."""
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield _load_line(line)
+
+def _dump_line(record):
+    """Serializes one output record (a ResultOut) as a newline-terminated UTF-8 JSONL line."""
+    if orjson is not None:
+        # orjson encodes dataclasses natively; answers parsed by literal_eval can
+        # have non-string dict keys
+        try:
+            return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            pass  # e.g. ints over 64 bits, which json writes fine
+    return (json.dumps(asdict(record)) + "\n").encode("utf-8")
+
+def _reject_constant(name):
+    raise ValueError(name)
+
+def _parse_literal(text):
+    """ast.literal_eval(text) with json.loads as the fast path.
+
+    JSON-only spellings (true/false/null, NaN/Infinity) are not Python literals, so
+    those strings skip JSON and give the same result literal_eval would.
+    """
+    if 'true' not in text and 'false' not in text and 'null' not in text:
+        try:
+            return json.loads(text, parse_constant=_reject_constant)
+        except ValueError:
+            pass
+    return ast.literal_eval(text)
+
+def _try_parse(text):
+    """_parse_literal(text), or None when text is not a literal."""
+    try:
+        return _parse_literal(text)
+    except Exception:
+        return None
 
+@functools.lru_cache(maxsize=256)
 def parse_format_hint(format_hint):
     """Parse format_hint to determine expected type."""
     format_hint = format_hint.strip()
-    if format_hint == "int":
+    if not format_hint:
+        return "str"
+    # Dispatch on the first character so each hint is compared at most once
+    first = format_hint[0]
+    if first == "{":
+        return "dict" if format_hint[-1] == "}" else "str"
+    elif first == "l":
+        return "list" if format_hint.startswith("list") else "str"
+    elif format_hint == "int":
         return "int"
     elif format_hint == "float":
         return "float"
-    elif format_hint.startswith("{") and format_hint.endswith("}"):
-        return "dict"
-    elif format_hint.startswith("list"):
-        return "list"
     else:
         return "str"
 
+# Default values for each type when answer is None or invalid
+_DEFAULTS = {
+    "int": 0,
+    "float": 0.0,
+    "dict": {},
+    "list": [],
+    "str": ""
+}
+
+# Answers the model gives when it has none (compared lowercased)
+_REJECT = frozenset({'na', 'n/a', 'no answer', 'none'})
+_REJECT_MAX_LEN = max(map(len, _REJECT))
+
+def _default(expected_type):
+    """Default for expected_type; dict/list are copied so callers never share the constant."""
+    default = _DEFAULTS[expected_type]
+    return default.copy() if isinstance(default, (dict, list)) else default
+
 def normalize_answer(final_answer, format_hint):
     """
     Normalize final_answer to match format_hint strictly per Output Contract.
@@ -41,31 +136,28 @@ def normalize_answer(final_answer, format_hint):
     """
     expected_type = parse_format_hint(format_hint)
     
-    # Default values for each type when answer is None or invalid
-    defaults = {
-        "int": 0,
-        "float": 0.0,
-        "dict": {},
-        "list": [],
-        "str": ""
-    }
-    
     if final_answer is None:
-        return defaults.get(expected_type, None), False
+        return _default(expected_type), False
     
-    # Reject "not applicable" or similar rejection strings
+    # Reject "not applicable" or similar rejection strings; lengths 10-13 can match
+    # neither, so those answers skip lower() entirely
     if isinstance(final_answer, str):
-        if 'not applicable' in final_answer.lower() or final_answer.lower() in ['na', 'n/a', 'no answer', 'none']:
-            return defaults.get(expected_type, None), False
+        n = len(final_answer)
+        if n <= _REJECT_MAX_LEN or n >= len('not applicable'):
+            low = final_answer.lower()
+            if low in _REJECT or 'not applicable' in low:
+                return _default(expected_type), False
     
     try:
-        # If it's a string representation, try to parse it
+        # If it's a string representation, parse it once; the branches below only
+        # look at the resulting type
+        quoted = False
         if isinstance(final_answer, str):
-            # Try to eval as Python literal
-            try:
-                final_answer = ast.literal_eval(final_answer)
-            except:
-                pass
+            parsed = _try_parse(final_answer)
+            if parsed is not None:
+                final_answer = parsed
+                # A quoted literal ('"[1, 2]"') decodes to yet another string
+                quoted = isinstance(parsed, str)
         
         if expected_type == "int":
             if isinstance(final_answer, (int, float)):
@@ -74,7 +166,7 @@ def normalize_answer(final_answer, format_hint):
                 try:
                     return int(float(final_answer)), True
                 except:
-                    return defaults["int"], False
+                    return _DEFAULTS["int"], False
         
         elif expected_type == "float":
             if isinstance(final_answer, (int, float)):
@@ -83,37 +175,31 @@ def normalize_answer(final_answer, format_hint):
                 try:
                     return round(float(final_answer), 2), True
                 except:
-                    return defaults["float"], False
+                    return _DEFAULTS["float"], False
         
         elif expected_type == "dict":
             if isinstance(final_answer, dict):
                 return final_answer, True
-            elif isinstance(final_answer, str):
-                try:
-                    parsed = ast.literal_eval(final_answer)
-                    if isinstance(parsed, dict):
-                        return parsed, True
-                except:
-                    pass
-            return defaults["dict"], False
+            elif quoted:
+                parsed = _try_parse(final_answer)
+                if isinstance(parsed, dict):
+                    return parsed, True
+            return _default("dict"), False
         
         elif expected_type == "list":
             if isinstance(final_answer, list):
                 return final_answer, True
-            elif isinstance(final_answer, str):
-                try:
-                    parsed = ast.literal_eval(final_answer)
-                    if isinstance(parsed, list):
-                        return parsed, True
-                except:
-                    pass
-            return defaults["list"], False
+            elif quoted:
+                parsed = _try_parse(final_answer)
+                if isinstance(parsed, list):
+                    return parsed, True
+            return _default("list"), False
         
         else:  # str
             return str(final_answer), True
     
     except Exception:
-        return defaults.get(expected_type, None), False
+        return _default(expected_type), False
 
 def is_valid_citation(c_str):
     """
@@ -125,11 +211,23 @@ def is_valid_citation(c_str):
     if '::chunk' in c_str:
         return True
     
-    # Valid table name: alphanumeric + underscores, no spaces or parens, reasonable length
-    if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', c_str) and len(c_str) < 50:
-        return True
-    
-    return False
+    # Valid table name: alphanumeric + underscores, no spaces or parens, reasonable length.
+    # Length and first character are checked first so most rejects skip the regex
+    if not c_str or len(c_str) >= 50:
+        return False
+    if not (c_str[0].isalpha() or c_str[0] == '_'):
+        return False
+    return _CITATION_RE.match(c_str) is not None
+
+def _sql_tables(sql_query):
+    """Table names referenced by sql_query, same as _TABLE_RE.findall(sql_query)."""
+    # The case-sensitive scan is only complete when every keyword is written in
+    # uppercase, i.e. uppercasing the query finds no extra occurrences
+    upper = sql_query.upper()
+    for kw in _TABLE_KEYWORDS:
+        if upper.count(kw) != sql_query.count(kw):
+            return _TABLE_RE.findall(sql_query)
+    return _TABLE_RE_FAST.findall(sql_query)
 
 def sanitize_citations(citations, sql_query):
     """
@@ -138,28 +236,18 @@ def sanitize_citations(citations, sql_query):
     Per Output Contract: citations must include only DB tables and doc chunk IDs,
     filtering out any explanatory text or invalid entries.
     """
-    result = []
-    
     # Extract table names from SQL if present
-    if sql_query:
-        # Simple regex to find table names (not perfect, but works for common cases)
-        table_pattern = r'\b(?:FROM|JOIN|INTO|UPDATE|DELETE\s+FROM)\s+[`"]?(\w+)[`"]?'
-        matches = re.findall(table_pattern, sql_query, re.IGNORECASE)
-        result.extend(set(matches))
+    seen = set(_sql_tables(sql_query)) if sql_query else set()
     
     # Add doc citations (filter out explanatory text)
-    if isinstance(citations, list):
-        for c in citations:
-            if isinstance(c, str):
-                c_str = c.strip()
-                if is_valid_citation(c_str) and c_str not in result:
-                    result.append(c_str)
-    elif isinstance(citations, str):
-        c_str = citations.strip()
-        if is_valid_citation(c_str) and c_str not in result:
-            result.append(c_str)
+    for c in citations if isinstance(citations, list) else [citations]:
+        if isinstance(c, str):
+            c_str = c.strip()
+            if is_valid_citation(c_str):
+                seen.add(c_str)
     
-    return sorted(list(set(result)))
+    # Sorted order is part of the output (stable diffs between runs); 0/1 items need no sort
+    return sorted(seen) if len(seen) > 1 else list(seen)
 
 def truncate_explanation(explanation, max_chars=250):
     """Truncate explanation to fit within 2 sentences (~250 chars)."""
@@ -167,22 +255,194 @@ def truncate_explanation(explanation, max_chars=250):
         return ""
     
     explanation = explanation.strip()
+    if len(explanation) <= max_chars:
+        return explanation
     
-    # Try to cut at sentence boundary within max_chars
-    sentences = re.split(r'(?<=[.!?])\s+', explanation)
-    result = ""
-    for sent in sentences:
-        if len(result) + len(sent) + 1 <= max_chars:
-            result += sent + " " if result else sent + " "
-        else:
-            break
+    # Cut after the last sentence end that fits within max_chars
+    cut = max(explanation.rfind(end, 0, max_chars + 1) for end in _SENTENCE_ENDS)
+    if cut > 0:
+        return explanation[:cut + 1]
+    # A single overlong sentence: hard cut
+    return explanation[:max_chars].rstrip()
+
+@dataclass(slots=True)
+class ResultOut:
+    """One Output Contract record; field order is the JSONL key order."""
+    id: str
+    final_answer: object
+    sql: str
+    confidence: float
+    explanation: str
+    citations: list
+
+# Graph results persisted across runs (opt-in with --cache), keyed by
+# question/format_hint/repair attempt plus everything that changes the answers
+_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "retail_agent")
+# Bump when the graph or prompts change in a way the file mtimes below would miss
+CACHE_VERSION = 1
+_invoke_cache = None  # shelve opened by main() with --cache
+_cache_fingerprint = ""  # set by main() alongside _invoke_cache
+_cache_lock = threading.Lock()
+
+def _fingerprint():
+    """CACHE_VERSION, the model tag and the mtimes of the DB, docs and agent sources."""
+    paths = [DB_PATH, *glob.glob(os.path.join("docs", "*.md")),
+             *glob.glob(os.path.join(ROOT, "agent", "**", "*.py"), recursive=True)]
+    stamp = sorted((p, os.path.getmtime(p)) for p in paths if os.path.exists(p))
+    return repr((CACHE_VERSION, MODEL, stamp))
+
+def _cache_key(state):
+    key = f'{_cache_fingerprint}|{state["question"]}|{state["format_hint"]}|{state["repair_count"]}'
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def invoke(state):
+    """app.invoke(state), answered from the on-disk cache when the same attempt ran before."""
+    if _invoke_cache is None:
+        return app.invoke(state)
+    key = _cache_key(state)
+    with _cache_lock:
+        cached = _invoke_cache.get(key)
+    if cached is not None:
+        return cached
+    final_state = app.invoke(state)
+    # SQL errors are not stored, so the next run tries the query again
+    if final_state.get("sql_error") is None:
+        with _cache_lock:
+            _invoke_cache[key] = final_state
+    return final_state
+
+# Questions run concurrently; each one's log lines go out in a single locked
+# write so blocks from different questions never interleave
+_print_lock = threading.Lock()
+
+def emit(log_lines):
+    with _print_lock:
+        sys.stdout.write("\n".join(log_lines) + "\n")
+
+def process_one(idx, q, total, route=None):
+    """Runs one question through the graph with the repair loop; returns its output record.
+
+    route is the (classification, complexity) pair from route_batch(); the graph
+    then skips its own router call on every attempt. None routes inside the graph.
+    """
+    log_lines = []
+    question_id = q.get("id", f"q_{idx}")
+    format_hint = q.get("format_hint", "")
+    question_text = q.get("question", "")
+    
+    log_lines.append(f"\n[{idx}/{total}] Processing: {question_id}")
+    log_lines.append(f"  Format: {format_hint} | Question: {question_text[:60]}...")
+    
+    # Repair loop: attempt up to 3 times (initial + 2 repairs)
+    final_answer = None
+    sql_query = ""
+    citations = []
+    explanation = ""
+    sql_error = None
+    is_valid = False
+    repair_count = 0
+    max_repairs = 2
+    
+    # Built once with the graph's own defaults; only the repair fields change between attempts
+    initial_state = AgentState(question=question_text, format_hint=format_hint)
+    if route is not None:
+        initial_state.classification, initial_state.complexity = route
+    
+    while repair_count <= max_repairs:
+        try:
+            initial_state.repair_count = repair_count
+            initial_state.sql_error = sql_error
+            initial_state.sql_query = sql_query
+            
+            # Run the LangGraph workflow
+            final_state = invoke(asdict(initial_state))
+            
+            # Extract raw outputs
+            final_answer_raw = final_state.get("final_answer")
+            sql_query = final_state.get("sql_query", "").strip()
+            sql_error = final_state.get("sql_error")
+            doc_citations = final_state.get("citations", [])
+            explanation_raw = final_state.get("explanation", "")
+            
+            # Normalize and validate final_answer against format_hint
+            final_answer, is_valid = normalize_answer(final_answer_raw, format_hint)
+            
+            # Sanitize citations (DB tables + doc chunk IDs only)
+            citations = sanitize_citations(doc_citations, sql_query)
+            
+            # Truncate explanation to 2 sentences (~250 chars)
+            explanation = truncate_explanation(explanation_raw)
+            
+            # Check if we should retry
+            if is_valid and sql_error is None:
+                # Success: valid answer and no SQL error
+                log_lines.append(f"  [Attempt {repair_count + 1}] SUCCESS. Answer: {str(final_answer)[:50]}")
+                break
+            elif repair_count < max_repairs and (sql_error is not None or not is_valid):
+                # Retry: SQL error or format mismatch and repairs remaining
+                if sql_error:
+                    log_lines.append(f"  [Attempt {repair_count + 1}] SQL error, retrying (repair {repair_count + 1}/{max_repairs})...")
+                else:
+                    log_lines.append(f"  [Attempt {repair_count + 1}] Format mismatch, retrying (repair {repair_count + 1}/{max_repairs})...")
+                repair_count += 1
+            else:
+                # No more repairs or partial success
+                if is_valid or sql_error is None:
+                    log_lines.append(f"  [Attempt {repair_count + 1}] PARTIAL. Answer: {str(final_answer)[:50]}")
+                else:
+                    log_lines.append(f"  [Attempt {repair_count + 1}] FAILED. No valid answer after {repair_count} repairs.")
+                break
+                
+        except Exception as e:
+            log_lines.append(f"  [Attempt {repair_count + 1}] ERROR: {str(e)[:80]}")
+            if repair_count < max_repairs:
+                log_lines.append(f"  Retrying (repair {repair_count + 1}/{max_repairs})...")
+                repair_count += 1
+            else:
+                log_lines.append(f"  No more repairs available.")
+                break
+    
+    # Determine confidence based on success criteria
+    # 1.0: no SQL error AND valid format answer
+    # 0.5: partial success (no SQL error OR valid format, but not both)
+    # 0.0: complete failure (SQL error AND invalid format)
+    has_sql_error = sql_error is not None
     
-    return result.strip()
+    if not has_sql_error and is_valid:
+        confidence = 1.0  # Perfect: no SQL error and valid format
+    elif (not has_sql_error) or is_valid:
+        confidence = 0.5  # Partial: one of the two succeeded
+    else:
+        confidence = 0.0  # Failed: both SQL error and format mismatch
+    
+    # Build Output Contract-compliant result
+    output = ResultOut(
+        id=question_id,
+        final_answer=final_answer,
+        sql=sql_query,
+        confidence=confidence,
+        explanation=explanation,
+        citations=citations
+    )
+    
+    log_lines.append(f"Confidence: {confidence} | Citations: {citations}")
+    emit(log_lines)
+    return output
+
+def route_group(group):
+    """route_batch() for a group of input records; on failure the graph routes each question itself."""
+    try:
+        return route_batch([q.get("question", "") for q in group])
+    except Exception as e:
+        print(f"WARNING: Batched routing failed, routing per question: {str(e)[:80]}")
+        return [None] * len(group)
 
 @click.command()
 @click.option('--batch', required=True, help='Path to input JSONL file')
 @click.option('--out', required=True, help='Path to output JSONL file')
-def main(batch, out):
+@click.option('--workers', default=8, show_default=True, help='Questions processed concurrently')
+@click.option('--cache/--no-cache', default=False, show_default=True, help=f'Reuse graph results cached in {_CACHE_PATH}')
+def main(batch, out, workers, cache):
     """
     Main execution loop for hybrid agent evaluation.
     Enforces strict Output Contract per specification:
@@ -193,143 +453,90 @@ def main(batch, out):
     """
     
     print("--- Starting Hybrid Agent Evaluation (with Output Contract Validation & Repair) ---")
-    results = []
     
-    # Load questions from JSONL
+    # Count questions up front (cheap, nothing is parsed) for the progress lines
     try:
-        with open(batch, 'r') as f:
-            questions = [json.loads(line) for line in f if line.strip()]
-        print(f"Loaded {len(questions)} questions from {batch}")
+        with open(batch, 'rb') as f:
+            total = sum(1 for line in f if line.strip())
+        print(f"Found {total} questions in {batch}")
     except Exception as e:
         print(f"ERROR: Failed to load questions: {e}")
         return
     
-    # Process each question
-    for idx, q in enumerate(questions, 1):
-        question_id = q.get("id", f"q_{idx}")
-        format_hint = q.get("format_hint", "")
-        question_text = q.get("question", "")
-        
-        print(f"\n[{idx}/{len(questions)}] Processing: {question_id}")
-        print(f"  Format: {format_hint} | Question: {question_text[:60]}...")
-        
-        # Repair loop: attempt up to 3 times (initial + 2 repairs)
-        final_answer = None
-        sql_query = ""
-        citations = []
-        explanation = ""
-        sql_error = None
-        is_valid = False
-        repair_count = 0
-        max_repairs = 2
-        
-        while repair_count <= max_repairs:
-            try:
-                initial_state = {
-                    "question": question_text,
-                    "format_hint": format_hint,
-                    "repair_count": repair_count,
-                    "sql_error": sql_error,
-                    "classification": "",
-                    "schema": "",
-                    "doc_context": [],
-                    "constraints": "",
-                    "sql_query": sql_query,
-                    "sql_result": None,
-                    "final_answer": None,
-                    "explanation": "",
-                    "citations": []
-                }
-                
-                # Run the LangGraph workflow
-                final_state = app.invoke(initial_state)
-                
-                # Extract raw outputs
-                final_answer_raw = final_state.get("final_answer")
-                sql_query = final_state.get("sql_query", "").strip()
-                sql_error = final_state.get("sql_error")
-                doc_citations = final_state.get("citations", [])
-                explanation_raw = final_state.get("explanation", "")
-                
-                # Normalize and validate final_answer against format_hint
-                final_answer, is_valid = normalize_answer(final_answer_raw, format_hint)
-                
-                # Sanitize citations (DB tables + doc chunk IDs only)
-                citations = sanitize_citations(doc_citations, sql_query)
-                
-                # Truncate explanation to 2 sentences (~250 chars)
-                explanation = truncate_explanation(explanation_raw)
-                
-                # Check if we should retry
-                if is_valid and sql_error is None:
-                    # Success: valid answer and no SQL error
-                    print(f"  [Attempt {repair_count + 1}] SUCCESS. Answer: {str(final_answer)[:50]}")
-                    break
-                elif repair_count < max_repairs and (sql_error is not None or not is_valid):
-                    # Retry: SQL error or format mismatch and repairs remaining
-                    if sql_error:
-                        print(f"  [Attempt {repair_count + 1}] SQL error, retrying (repair {repair_count + 1}/{max_repairs})...")
-                    else:
-                        print(f"  [Attempt {repair_count + 1}] Format mismatch, retrying (repair {repair_count + 1}/{max_repairs})...")
-                    repair_count += 1
-                else:
-                    # No more repairs or partial success
-                    if is_valid or sql_error is None:
-                        print(f"  [Attempt {repair_count + 1}] PARTIAL. Answer: {str(final_answer)[:50]}")
-                    else:
-                        print(f"  [Attempt {repair_count + 1}] FAILED. No valid answer after {repair_count} repairs.")
-                    break
-                    
-            except Exception as e:
-                print(f"  [Attempt {repair_count + 1}] ERROR: {str(e)[:80]}")
-                if repair_count < max_repairs:
-                    print(f"  Retrying (repair {repair_count + 1}/{max_repairs})...")
-                    repair_count += 1
-                else:
-                    print(f"  No more repairs available.")
-                    break
-        
-        # Determine confidence based on success criteria
-        # 1.0: no SQL error AND valid format answer
-        # 0.5: partial success (no SQL error OR valid format, but not both)
-        # 0.0: complete failure (SQL error AND invalid format)
-        has_sql_error = sql_error is not None
-        
-        if not has_sql_error and is_valid:
-            confidence = 1.0  # Perfect: no SQL error and valid format
-        elif (not has_sql_error) or is_valid:
-            confidence = 0.5  # Partial: one of the two succeeded
-        else:
-            confidence = 0.0  # Failed: both SQL error and format mismatch
-        
-        # Build Output Contract-compliant result
-        output = {
-            "id": question_id,
-            "final_answer": final_answer,
-            "sql": sql_query,
-            "confidence": confidence,
-            "explanation": explanation,
-            "citations": citations
-        }
-        
-        print(f"Confidence: {confidence} | Citations: {citations}")
-        results.append(output)
+    global _invoke_cache, _cache_fingerprint
+    if cache:
+        os.makedirs(os.path.dirname(_CACHE_PATH), exist_ok=True)
+        _cache_fingerprint = _fingerprint()
+        _invoke_cache = shelve.open(_CACHE_PATH)
     
-    # Write results to output file (Output Contract format)
-    print(f"\n--- Writing Results (Output Contract Format) ---")
+    # Questions are read, processed and written one at a time; each result is
+    # flushed as soon as it and everything before it are done, so a killed run
+    # still leaves a valid partial output file
+    counts = {1.0: 0, 0.5: 0, 0.0: 0}
+    written = 0
     try:
-        with open(out, 'w') as f:
-            for r in results:
-                f.write(json.dumps(r) + "\n")
-        print(f"Wrote {len(results)} results to {out}")
+        with open(out, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+            # At most 2 * workers questions in flight, written back in input order
+            pending = deque()
+            
+            def write_next():
+                nonlocal written
+                question_id, future = pending.popleft()
+                try:
+                    output = future.result()
+                except Exception as e:
+                    print(f"ERROR: {question_id} failed: {str(e)[:80]}")
+                    output = ResultOut(id=question_id, final_answer=None, sql="",
+                                       confidence=0.0, explanation="", citations=[])
+                try:
+                    line = _dump_line(output)
+                except (TypeError, ValueError) as e:
+                    # One unserializable answer must not cost the rest of the batch
+                    print(f"ERROR: Could not serialize result for {question_id}: {str(e)[:80]}")
+                    output = replace(output, final_answer=None, confidence=0.0)
+                    line = _dump_line(output)
+                f.write(line)
+                f.flush()
+                counts[output.confidence] += 1
+                written += 1
+
+            questions = iter_questions(batch)
+            idx = 0
+            more = True
+            # One batched router call per BATCH_SIZE questions; workers keep
+            # running earlier questions meanwhile
+            while more:
+                group = []
+                try:
+                    # Lines parsed before a bad one stay in the group
+                    group.extend(islice(questions, BATCH_SIZE))
+                except Exception as e:
+                    print(f"ERROR: Failed to load questions: {e}")
+                    more = False
+                more = more and len(group) == BATCH_SIZE
+                if not group:
+                    continue
+                for q, route in zip(group, route_group(group)):
+                    idx += 1
+                    future = executor.submit(process_one, idx, q, total, route)
+                    pending.append((q.get("id", f"q_{idx}"), future))
+                    if len(pending) >= 2 * workers:
+                        write_next()
+            # Questions already submitted still get written
+            while pending:
+                write_next()
     except Exception as e:
         print(f"ERROR: Failed to write output: {e}")
+    finally:
+        if _invoke_cache is not None:
+            _invoke_cache.close()
+            _invoke_cache = None
+    
+    print(f"\n--- Results (Output Contract Format) ---")
+    print(f"Wrote {written} results to {out}")
     
     print(f"\n--- Summary ---")
-    valid_count = sum(1 for r in results if r.get("confidence") == 1.0)
-    partial_count = sum(1 for r in results if r.get("confidence") == 0.5)
-    error_count = sum(1 for r in results if r.get("confidence") == 0.0)
-    print(f"Valid: {valid_count}/{len(results)} | Partial: {partial_count} | Error: {error_count}")
+    print(f"Valid: {counts[1.0]}/{written} | Partial: {counts[0.5]} | Error: {counts[0.0]}")
     print(f"Output file: {out}")
 
 if __name__ == "__main__":
@@ -1,6 +1,11 @@
 import click
 import json
+import os
+import sys
 import traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 # Mock the graph for testing (no Ollama dependency)
 class MockApp:
@@ -62,17 +67,93 @@ class MockApp:
 
 app = MockApp()
 
+# Questions run concurrently; each one's log lines go out in a single locked
+# write so blocks from different questions never interleave
+_print_lock = threading.Lock()
+
+def emit(log_lines):
+    with _print_lock:
+        sys.stdout.write("\n".join(log_lines) + "\n")
+
+def process_one(idx, q, total):
+    """Runs one question through the mock workflow; returns its output record."""
+    log_lines = []
+    question_id = q.get("id", f"q_{idx}")
+    log_lines.append(f"\n[{idx}/{total}] Processing: {question_id}")
+    log_lines.append(f"  Question: {q.get('question', '')[:80]}...")
+    
+    try:
+        initial_state = {
+            "question": q.get("question", ""),
+            "format_hint": q.get("format_hint", ""),
+            "repair_count": 0,
+            "sql_error": None,
+            "classification": "",
+            "schema": "",
+            "doc_context": [],
+            "constraints": "",
+            "sql_query": "",
+            "sql_result": None,
+            "final_answer": None,
+            "explanation": "",
+            "citations": []
+        }
+        
+        # Run the mock workflow
+        log_lines.append(f"  Running workflow...")
+        final_state = app.invoke(initial_state)
+        
+        # Extract and format output
+        output = {
+            "id": question_id,
+            "question": q.get("question", ""),
+            "format_hint": q.get("format_hint", ""),
+            "final_answer": final_state.get("final_answer"),
+            "sql": final_state.get("sql_query", ""),
+            "sql_error": final_state.get("sql_error"),
+            "confidence": 1.0 if not final_state.get("sql_error") else 0.5,
+            "explanation": final_state.get("explanation", ""),
+            "citations": final_state.get("citations", [])
+        }
+        
+        log_lines.append(f"  ✓ Success. Answer: {str(final_state.get('final_answer', 'N/A'))[:60]}")
+        emit(log_lines)
+        return output
+        
+    except Exception as e:
+        log_lines.append(f"  ✗ ERROR: {str(e)}")
+        # Formatting every frame is only worth it when debugging
+        if os.environ.get("DEBUG"):
+            log_lines.append(f"  Traceback: {traceback.format_exc()}")
+        else:
+            log_lines.append(f"  Error: {''.join(traceback.format_exception_only(type(e), e)).strip()}")
+        
+        # Still add result with error info
+        output = {
+            "id": question_id,
+            "question": q.get("question", ""),
+            "format_hint": q.get("format_hint", ""),
+            "final_answer": None,
+            "sql": "",
+            "sql_error": str(e),
+            "confidence": 0.0,
+            "explanation": f"Error during processing: {str(e)}",
+            "citations": []
+        }
+        emit(log_lines)
+        return output
+
 @click.command()
 @click.option('--batch', required=True, help='Path to input JSONL file')
 @click.option('--out', required=True, help='Path to output JSONL file')
-def main(batch, out):
+@click.option('--workers', default=8, show_default=True, help='Questions processed concurrently')
+def main(batch, out, workers):
     """
     Main execution loop for hybrid agent evaluation (TEST VERSION).
     Uses mock responses instead of calling Ollama.
     """
     
     print("--- Starting Hybrid Agent Evaluation (TEST MODE) ---")
-    results = []
     
     # Load questions from JSONL
     try:
@@ -83,66 +164,15 @@ def main(batch, out):
         print(f"ERROR: Failed to load questions: {e}")
         return
     
-    # Process each question
-    for idx, q in enumerate(questions, 1):
-        question_id = q.get("id", f"q_{idx}")
-        print(f"\n[{idx}/{len(questions)}] Processing: {question_id}")
-        print(f"  Question: {q.get('question', '')[:80]}...")
-        
-        try:
-            initial_state = {
-                "question": q.get("question", ""),
-                "format_hint": q.get("format_hint", ""),
-                "repair_count": 0,
-                "sql_error": None,
-                "classification": "",
-                "schema": "",
-                "doc_context": [],
-                "constraints": "",
-                "sql_query": "",
-                "sql_result": None,
-                "final_answer": None,
-                "explanation": "",
-                "citations": []
-            }
-            
-            # Run the mock workflow
-            print(f"  Running workflow...")
-            final_state = app.invoke(initial_state)
-            
-            # Extract and format output
-            output = {
-                "id": question_id,
-                "question": q.get("question", ""),
-                "format_hint": q.get("format_hint", ""),
-                "final_answer": final_state.get("final_answer"),
-                "sql": final_state.get("sql_query", ""),
-                "sql_error": final_state.get("sql_error"),
-                "confidence": 1.0 if not final_state.get("sql_error") else 0.5,
-                "explanation": final_state.get("explanation", ""),
-                "citations": final_state.get("citations", [])
-            }
-            
-            print(f"  ✓ Success. Answer: {str(final_state.get('final_answer', 'N/A'))[:60]}")
-            results.append(output)
-            
-        except Exception as e:
-            print(f"  ✗ ERROR: {str(e)}")
-            print(f"  Traceback: {traceback.format_exc()}")
-            
-            # Still add result with error info
-            output = {
-                "id": question_id,
-                "question": q.get("question", ""),
-                "format_hint": q.get("format_hint", ""),
-                "final_answer": None,
-                "sql": "",
-                "sql_error": str(e),
-                "confidence": 0.0,
-                "explanation": f"Error during processing: {str(e)}",
-                "citations": []
-            }
+    # Process questions concurrently, results keep the input order; the summary
+    # is counted while collecting instead of rescanning results afterwards
+    results = []
+    successful = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for output in executor.map(process_one, range(1, len(questions) + 1), questions, repeat(len(questions))):
             results.append(output)
+            if output.get("sql_error") is None:
+                successful += 1
     
     # Write results to output file
     print(f"\n--- Writing Results ---")
@@ -155,7 +185,6 @@ def main(batch, out):
         print(f"ERROR: Failed to write output: {e}")
     
     print(f"\n--- Summary ---")
-    successful = sum(1 for r in results if r.get("sql_error") is None)
     print(f"Successful: {successful}/{len(results)}")
     print(f"Output file: {out}")
 
@@ -5,8 +5,22 @@ Uses mock responses to avoid Ollama dependency.
 """
 
 import json
+import multiprocessing
+import os
 import sys
 
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the stdlib json module
+    orjson = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # optional; validate_batch then uses NumPy only
+    njit = None
+
 # Mock workflow responses
 mock_responses = [
     {
@@ -63,74 +77,270 @@ mock_responses = [
     },
 ]
 
-def validate_output_contract(record):
-    """Validate that a record follows the Output Contract."""
+# Column view of mock_responses (structure of arrays): the record builder walks
+# parallel lists instead of looking up five keys in every response dict
+question_ids = [resp["question_id"] for resp in mock_responses]
+final_answers = [resp["final_answer"] for resp in mock_responses]
+sql_queries = [resp["sql_query"] for resp in mock_responses]
+sql_errors = [resp["sql_error"] for resp in mock_responses]
+explanations = [resp["explanation"] for resp in mock_responses]
+citation_lists = [resp["citations"] for resp in mock_responses]
+# 1.0 without a SQL error, else 0.0, computed for the whole column at once;
+# tolist() hands back Python floats for the serializers
+no_sql_error = np.fromiter((err is None for err in sql_errors), dtype=bool, count=len(sql_errors))
+confidences = no_sql_error.astype(np.float64).tolist()
+
+# Fallback encoder specialized for our records: they are trees built in this
+# script, so the per-call cycle check json.dumps does can be skipped
+_RECORD_ENCODER = json.JSONEncoder(check_circular=False)
+
+def dumps(record):
+    """Serializes record to compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(record)
+    return _RECORD_ENCODER.encode(record).encode("utf-8")
+
+def dumps_pretty(record):
+    """Serializes record as indented JSON text for display."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(record, indent=2)
+
+def _iov_max():
+    try:
+        n = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        n = -1
+    return n if n > 0 else 1024
+
+IOV_MAX = _iov_max()
+
+def write_vectored(f, chunks):
+    """Writes the byte chunks to f with one writev() syscall per IOV_MAX chunks,
+    without joining them first.
+
+    Falls back to a single joined write where os.writev is unavailable (Windows)
+    and finishes any short write with plain writes.
+    """
+    if not hasattr(os, "writev"):
+        f.write(b"".join(chunks))
+        return
+    f.flush()
+    fd = f.fileno()
+    for start in range(0, len(chunks), IOV_MAX):
+        batch = chunks[start:start + IOV_MAX]
+        written = os.writev(fd, batch)
+        if written < sum(map(len, batch)):
+            rest = memoryview(b"".join(batch))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+REQUIRED_FIELDS = ("id", "final_answer", "sql", "confidence", "explanation", "citations")
+REQUIRED = frozenset(REQUIRED_FIELDS)
+MAX_EXPLANATION_CHARS = 250
+
+# Fixed message prefixes, interned once; each message is then a single concat
+_MISSING = sys.intern("Missing required field: ")
+_INVALID_CONF = sys.intern("Invalid confidence: ")
+_CONF_RANGE = sys.intern(" (must be float 0.0-1.0)")
+_SQL_TYPE = sys.intern("SQL must be string, got ")
+_EXP_TYPE = sys.intern("Explanation must be string, got ")
+_EXP_LONG = sys.intern("Explanation too long (")
+_EXP_MAX = sys.intern(f" chars, max {MAX_EXPLANATION_CHARS})")
+_CITES_TYPE = sys.intern("Citations must be list, got ")
+_CITE_TYPE = sys.intern("Citation must be string, got ")
+
+def unique_sorted(items):
+    """Deduplicated, sorted copy of items; 0/1 items skip the sort."""
+    if len(items) <= 1:
+        return list(items)
+    return sorted(dict.fromkeys(items))
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _check(conf, explen, max_chars):
+        """validate_batch's mask as one parallel compiled loop (no fastmath: NaN must fail)."""
+        out = np.empty(conf.size, np.uint8)
+        for i in prange(conf.size):
+            bad_conf = not (conf[i] >= 0.0 and conf[i] <= 1.0)
+            out[i] = np.uint8(bad_conf) | (np.uint8(explen[i] > max_chars) << 1)
+        return out
+
+# The compiled loop pays off (and amortizes thread start-up) only on big batches
+NUMBA_MIN_RECORDS = 100_000
+
+def validate_batch(confidences, explanation_lengths):
+    """Numeric contract checks for a whole batch at once.
+
+    Returns a uint8 mask per record: bit 0 is set when the confidence is outside
+    [0.0, 1.0] (or NaN), bit 1 when the explanation is over MAX_EXPLANATION_CHARS.
+    """
+    conf = np.asarray(confidences, dtype=np.float64)
+    explen = np.asarray(explanation_lengths, dtype=np.int32)
+    if njit is not None and conf.size >= NUMBA_MIN_RECORDS:
+        return _check(conf, explen, MAX_EXPLANATION_CHARS)
+    bad_conf = ~((conf >= 0.0) & (conf <= 1.0))
+    too_long = explen > MAX_EXPLANATION_CHARS
+    return bad_conf.astype(np.uint8) | (too_long.astype(np.uint8) << 1)
+
+def validate_output_contract(record, check_numeric=True):
+    """Validate that a record follows the Output Contract.
+
+    check_numeric=False skips the confidence and explanation-length checks, for
+    records whose numeric fields already passed validate_batch.
+    """
     errors = []
     
-    # Check required fields
-    required_fields = ["id", "final_answer", "sql", "confidence", "explanation", "citations"]
-    for field in required_fields:
-        if field not in record:
-            errors.append(f"Missing required field: {field}")
+    # Check required fields: one C-level set difference; messages keep field order
+    missing = REQUIRED.difference(record)
+    if missing:
+        errors.extend(_MISSING + field for field in REQUIRED_FIELDS if field in missing)
     
-    # Validate types
-    if "confidence" in record:
+    # Validate types. Records built here have exactly these types, so a type
+    # identity check settles them; isinstance() only runs for other types
+    # (subclasses such as bool still pass, as before)
+    if check_numeric and "confidence" in record:
         conf = record["confidence"]
-        if not isinstance(conf, (int, float)) or not (0.0 <= conf <= 1.0):
-            errors.append(f"Invalid confidence: {conf} (must be float 0.0-1.0)")
+        t = type(conf)
+        if not ((t is float or t is int or isinstance(conf, (int, float))) and 0.0 <= conf <= 1.0):
+            errors.append(_INVALID_CONF + str(conf) + _CONF_RANGE)
     
     if "sql" in record:
-        if not isinstance(record["sql"], str):
-            errors.append(f"SQL must be string, got {type(record['sql'])}")
+        sql = record["sql"]
+        if not (type(sql) is str or isinstance(sql, str)):
+            errors.append(_SQL_TYPE + type(sql).__name__)
     
     if "explanation" in record:
         exp = record["explanation"]
-        if not isinstance(exp, str):
-            errors.append(f"Explanation must be string, got {type(exp)}")
-        if len(exp) > 250:
-            errors.append(f"Explanation too long ({len(exp)} chars, max 250)")
+        if not (type(exp) is str or isinstance(exp, str)):
+            errors.append(_EXP_TYPE + type(exp).__name__)
+        if check_numeric:
+            n_chars = len(exp)
+            if n_chars > MAX_EXPLANATION_CHARS:
+                errors.append(_EXP_LONG + str(n_chars) + _EXP_MAX)
     
     if "citations" in record:
-        if not isinstance(record["citations"], list):
-            errors.append(f"Citations must be list, got {type(record['citations'])}")
-        for cite in record["citations"]:
-            if not isinstance(cite, str):
-                errors.append(f"Citation must be string, got {type(cite)}")
+        cites = record["citations"]
+        if not (type(cites) is list or isinstance(cites, list)):
+            errors.append(_CITES_TYPE + type(cites).__name__)
+        for cite in cites:
+            if not (type(cite) is str or isinstance(cite, str)):
+                errors.append(_CITE_TYPE + type(cite).__name__)
     
     return errors
 
-# Generate test output
-print("Generating test output with Output Contract validation...\n")
-output_lines = []
-
-for resp in mock_responses:
-    record = {
-        "id": resp["question_id"],
-        "final_answer": resp["final_answer"],
-        "sql": resp["sql_query"],
-        "confidence": 1.0 if resp["sql_error"] is None else 0.0,
-        "explanation": resp["explanation"][:250],  # Truncate to 250 chars
-        "citations": sorted(list(set(resp["citations"])))  # Unique, sorted
-    }
-    
-    errors = validate_output_contract(record)
-    if errors:
-        print(f"❌ {record['id']}:")
-        for err in errors:
-            print(f"   - {err}")
-    else:
-        print(f"✓ {record['id']}")
+OUTPUT_FILE = "outputs_hybrid_contract_test.jsonl"
+# Below this many records a process pool costs more than it saves
+PARALLEL_MIN_RECORDS = 10_000
+CHUNK_RECORDS = 1_000
+# Records are built by iter_records() below, so their schema holds by
+# construction. VALIDATE=0 (or python -O) skips the per-record validator; the
+# first record is still fully validated once in main()
+VALIDATE = os.environ.get("VALIDATE", "1") != "0"
+
+# Truncate explanations to 250 chars, then check all numeric fields in one batch
+truncated_explanations = [exp if len(exp) <= MAX_EXPLANATION_CHARS else exp[:MAX_EXPLANATION_CHARS]
+                          for exp in explanations]
+numeric_error_mask = validate_batch(
+    confidences,
+    np.fromiter(map(len, truncated_explanations), dtype=np.int32, count=len(truncated_explanations)))
+
+def iter_records(start=0, stop=None):
+    """Yields (record, numeric_errors) for records [start, stop), built from the columns above."""
+    rows = slice(start, stop)
+    for qid, answer, sql, conf, exp, cites, numeric_errors in zip(
+            question_ids[rows], final_answers[rows], sql_queries[rows], confidences[rows],
+            truncated_explanations[rows], citation_lists[rows], numeric_error_mask[rows].tolist()):
+        record = {
+            "id": qid,
+            "final_answer": answer,
+            "sql": sql,
+            "confidence": conf,
+            "explanation": exp,
+            "citations": unique_sorted(cites)
+        }
+        yield record, numeric_errors
+
+def emit_lines(messages, start=0, stop=None):
+    """Validates and serializes records [start, stop); yields one JSONL line per record.
+
+    Lines are produced as the writer asks for them, so no list of lines is kept.
+    Validation results are appended to messages instead of printed one by one;
+    with validation off (see VALIDATE) messages is left untouched.
+    """
+    if not (__debug__ and VALIDATE):
+        for record, _ in iter_records(start, stop):
+            yield dumps(record)
+        return
     
-    output_lines.append(json.dumps(record))
+    for record, numeric_errors in iter_records(start, stop):
+        # Only records the batch check flagged re-run the numeric checks in Python
+        errors = validate_output_contract(record, check_numeric=numeric_errors != 0)
+        if errors:
+            messages.append(f"❌ {record['id']}:")
+            messages.extend(f"   - {err}" for err in errors)
+        else:
+            messages.append(f"✓ {record['id']}")
+        
+        yield dumps(record)
 
-# Write to file
-output_file = "outputs_hybrid_contract_test.jsonl"
-with open(output_file, 'w') as f:
-    for line in output_lines:
-        f.write(line + "\n")
+def serialize_chunk(bounds):
+    """Pool worker: returns (JSONL bytes, validation messages) for records [start, stop)."""
+    start, stop = bounds
+    messages = []
+    chunk = bytearray()
+    for line in emit_lines(messages, start, stop):
+        chunk += line
+        chunk += b"\n"
+    return bytes(chunk), messages
 
-print(f"\n✓ Wrote {len(output_lines)} records to {output_file}")
+def main():
+    print("Generating test output with Output Contract validation...\n")
+    n_records = len(question_ids)
+    record_count = 0
+    messages = []
+    
+    # One full check of a constructed record catches a schema regression even
+    # when per-record validation is off
+    first_record = next(iter_records(0, 1))[0] if n_records else None
+    if first_record is not None:
+        errors = validate_output_contract(first_record)
+        if errors:
+            print(f"❌ Schema check failed for {first_record['id']}:")
+            print("\n".join(f"   - {err}" for err in errors))
+    
+    with open(OUTPUT_FILE, 'wb') as f:
+        if n_records >= PARALLEL_MIN_RECORDS and (os.cpu_count() or 1) > 1:
+            # Records are independent: workers serialize chunks, written back in order
+            bounds = [(i, min(i + CHUNK_RECORDS, n_records)) for i in range(0, n_records, CHUNK_RECORDS)]
+            with multiprocessing.Pool() as pool:
+                for chunk, chunk_messages in pool.imap(serialize_chunk, bounds):
+                    f.write(chunk)
+                    messages.extend(chunk_messages)
+            record_count = n_records
+        else:
+            # Lines are queued as (line, newline) iovecs and handed to the kernel
+            # in batches of at most IOV_MAX, one writev() each
+            iov = []
+            for line in emit_lines(messages):
+                iov.append(line)
+                iov.append(b"\n")
+                record_count += 1
+                if len(iov) >= IOV_MAX:
+                    write_vectored(f, iov)
+                    iov.clear()
+            
+            write_vectored(f, iov)
+    
+    # All per-record results in one write
+    if messages:
+        sys.stdout.write("\n".join(messages) + "\n")
+    print(f"\n✓ Wrote {record_count} records to {OUTPUT_FILE}")
+    
+    # Display first record as sample (the dict itself, not its parsed JSONL line)
+    if first_record is not None:
+        print(f"\nSample record (first line):")
+        print(dumps_pretty(first_record))
 
-# Display first record as sample
-print(f"\nSample record (first line):")
-print(json.dumps(json.loads(output_lines[0]), indent=2))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Checks the large-batch paths of test_output_contract.py against the default ones.
+
+The mock batch has 6 records, far below PARALLEL_MIN_RECORDS and NUMBA_MIN_RECORDS,
+so these tests lower the thresholds to force the process-pool writer and the
+compiled numeric check, then compare them with the serial / NumPy results.
+
+Run with: python -m pytest test_output_contract_paths.py
+"""
+import numpy as np
+import pytest
+
+import test_output_contract as toc
+
+
+def run_main(monkeypatch, capsys, out_path):
+    monkeypatch.setattr(toc, "OUTPUT_FILE", str(out_path))
+    toc.main()
+    return out_path.read_bytes(), capsys.readouterr().out
+
+
+def test_pool_path_matches_serial(monkeypatch, capsys, tmp_path):
+    out_path = tmp_path / "out.jsonl"
+    serial_bytes, serial_log = run_main(monkeypatch, capsys, out_path)
+
+    # Pool path for any batch size and machine; 2-record chunks so results come back from several workers
+    monkeypatch.setattr(toc, "PARALLEL_MIN_RECORDS", 1)
+    monkeypatch.setattr(toc, "CHUNK_RECORDS", 2)
+    monkeypatch.setattr(toc.os, "cpu_count", lambda: 2)
+    pool_bytes, pool_log = run_main(monkeypatch, capsys, out_path)
+
+    assert pool_bytes == serial_bytes
+    assert pool_log == serial_log
+
+
+@pytest.mark.skipif(toc.njit is None, reason="numba not installed")
+def test_numba_check_matches_numpy(monkeypatch):
+    rng = np.random.default_rng(0)
+    n = 1_000
+    confidences = rng.uniform(-0.5, 1.5, n)
+    confidences[::7] = np.nan
+    confidences[::11] = 1.0
+    confidences[::13] = 0.0
+    lengths = rng.integers(0, 2 * toc.MAX_EXPLANATION_CHARS, n)
+    lengths[::17] = toc.MAX_EXPLANATION_CHARS
+
+    numpy_mask = toc.validate_batch(confidences, lengths)
+    monkeypatch.setattr(toc, "NUMBA_MIN_RECORDS", 1)
+    numba_mask = toc.validate_batch(confidences, lengths)
+
+    assert numba_mask.dtype == numpy_mask.dtype
+    np.testing.assert_array_equal(numba_mask, numpy_mask)